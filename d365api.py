@@ -24,27 +24,67 @@ SOFTWARE.
 """
 
 from urllib.parse import urlencode
+import json as json_lib
 import re
+import uuid
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib parser
+    orjson = None
+
+_GUID_RE = re.compile(r'^[\da-f]{8}-([\da-f]{4}-){3}[\da-f]{12}$', re.IGNORECASE)
+
+# Sentinel returned by parse_response when a conditional request gets a 304,
+# so callers can tell "nothing changed" apart from an actual payload
+NOT_MODIFIED = object()
 
 
 class Client:
     api_path = "api/data/v9.2"
 
+    _ERROR_TEMPLATES = {
+        400: "The URL {url} retrieved an {code} error. Please check your request body and try again.\nRaw message: {text}",
+        401: "The URL {url} retrieved and {code} error. Please check your credentials, make sure you have permission to perform this action and try again.",
+        403: "The URL {url} retrieved and {code} error. Please check your credentials, make sure you have permission to perform this action and try again.",
+        404: "The URL {url} retrieved an {code} error. Please check the URL and try again.\nRaw message: {text}",
+        412: "The URL {url} retrieved an {code} error. Please check the URL and try again.\nRaw message: {text}",
+        413: "The URL {url} retrieved an {code} error. Please check the URL and try again.\nRaw message: {text}",
+        500: "The URL {url} retrieved an {code} error. Please check the URL and try again.\nRaw message: {text}",
+        501: "The URL {url} retrieved an {code} error. Please check the URL and try again.\nRaw message: {text}",
+        503: "The URL {url} retrieved an {code} error. Please check the URL and try again.\nRaw message: {text}",
+    }
+
     def __init__(self, domain, client_id=None, client_secret=None, access_token=None):
         self.domain = domain.strip("/")
+        self._base_url = f"{self.domain}/{self.api_path}/"
         self.scopes = [f"{domain}/user_impersonation"]
         self.client_id = client_id
         self.client_secret = client_secret
         self.access_token = access_token
+        self.last_response_etag = None
 
         self.headers = {
             "Accept": "application/json, */*",
+            "Accept-Encoding": "gzip, deflate",
             "OData-MaxVersion": "4.0",
             "OData-Version": "4.0",
         }
 
+        # Keep a single pooled session so TCP+TLS connections to the D365 host
+        # are reused across calls instead of being torn down every request
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]),
+        ))
+        self.session.headers.update(self.headers)
+
         if access_token is not None:
             self.set_access_token(access_token)
 
@@ -57,6 +97,20 @@ class Client:
         assert token is not None, "The token cannot be None."
         self.access_token = token
         self.headers["Authorization"] = "Bearer " + self.access_token
+        self.session.headers["Authorization"] = self.headers["Authorization"]
+
+    def close(self):
+        """
+        Closes the underlying session, releasing the pooled connections.
+        :return:
+        """
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def make_request(
         self,
@@ -70,6 +124,7 @@ class Client:
         top=None,
         data=None,
         json=None,
+        extra_headers=None,
         **kwargs,
     ):
         """
@@ -85,12 +140,13 @@ class Client:
         :param top:
         :param data:
         :param json:
+        :param extra_headers: A dict of additional headers for this request only (e.g. If-None-Match).
         :param kwargs:
         :return:
         """
         extra = {}
         if expand is not None and isinstance(expand, str):
-            extra["$expand"] = str(expand)
+            extra["$expand"] = expand
         if filter is not None and isinstance(filter, str):
             extra["$filter"] = filter
         if orderby is not None and isinstance(orderby, str):
@@ -100,18 +156,40 @@ class Client:
         if skip is not None and isinstance(skip, str):
             extra["$skip"] = skip
         if top is not None and isinstance(top, str):
-            extra["$top"] = str(top)
+            extra["$top"] = top
 
         assert self.domain is not None, "'domain' is required"
         assert self.access_token is not None, "You must provide a 'token' to make requests"
-        url = f"{self.domain}/{self.api_path}/{endpoint}?" + urlencode(extra)
+        url = self._base_url + endpoint + ("?" + urlencode(extra) if extra else "")
+        headers = self.headers if extra_headers is None else {**self.headers, **extra_headers}
         if method == "get":
-            response = requests.request(method, url, headers=self.headers, params=kwargs)
+            response = self.session.request(method, url, headers=headers, params=kwargs)
         else:
-            response = requests.request(method, url, headers=self.headers, data=data, json=json)
+            response = self.session.request(method, url, headers=headers, data=data, json=json)
 
         return self.parse_response(response)
 
+    def iter_pages(self, endpoint, **kwargs):
+        """
+        This method performs a GET request and yields the 'value' list of each
+        result page, following @odata.nextLink so only one page of parsed JSON
+        is kept in memory at a time.
+        :param endpoint:
+        :param kwargs: The same OData parameters accepted by make_request.
+        :return: A generator of per-page entity lists.
+        """
+        result = self.make_request("get", endpoint, **kwargs)
+        if result is NOT_MODIFIED:  # Conditional request, nothing new to page through
+            yield result
+            return
+        while True:
+            yield result.get("value", [])
+            next_link = result.get("@odata.nextLink")
+            if next_link is None:
+                break
+            response = self.session.get(next_link, headers=self.headers)
+            result = self.parse_response(response)
+
     def _get(self, endpoint, data=None, **kwargs):
         return self.make_request("get", endpoint, data=data, **kwargs)
 
@@ -130,72 +208,28 @@ class Client:
         :param response:
         :return:
         """
+        self.last_response_etag = response.headers.get('ETag')
+        if response.status_code == 304:
+            return NOT_MODIFIED
         if response.status_code == 204 or response.status_code == 201:
             if 'OData-EntityId' in response.headers:
                 entity_id = response.headers['OData-EntityId']
                 if entity_id[-38:-37] == '(' and entity_id[-1:] == ')':  # Check container
                     guid = entity_id[-37:-1]
-                    guid_pattern = re.compile(r'^[\da-f]{8}-([\da-f]{4}-){3}[\da-f]{12}$', re.IGNORECASE)
-                    if guid_pattern.match(guid):
+                    if _GUID_RE.match(guid):
                         return guid
                     else:
                         return True  # Not all calls return a guid
             else:
                 return True
-        elif response.status_code == 400:
-            raise Exception(
-                "The URL {0} retrieved an {1} error. Please check your request body and try again.\nRaw message: {2}".format(
-                    response.url, response.status_code, response.text
-                )
-            )
-        elif response.status_code == 401:
-            raise Exception(
-                "The URL {0} retrieved and {1} error. Please check your credentials, make sure you have permission to perform this action and try again.".format(
-                    response.url, response.status_code
-                )
-            )
-        elif response.status_code == 403:
-            raise Exception(
-                "The URL {0} retrieved and {1} error. Please check your credentials, make sure you have permission to perform this action and try again.".format(
-                    response.url, response.status_code
-                )
-            )
-        elif response.status_code == 404:
-            raise Exception(
-                "The URL {0} retrieved an {1} error. Please check the URL and try again.\nRaw message: {2}".format(
-                    response.url, response.status_code, response.text
-                )
-            )
-        elif response.status_code == 412:
-            raise Exception(
-                "The URL {0} retrieved an {1} error. Please check the URL and try again.\nRaw message: {2}".format(
-                    response.url, response.status_code, response.text
-                )
-            )
-        elif response.status_code == 413:
-            raise Exception(
-                "The URL {0} retrieved an {1} error. Please check the URL and try again.\nRaw message: {2}".format(
-                    response.url, response.status_code, response.text
-                )
-            )
-        elif response.status_code == 500:
-            raise Exception(
-                "The URL {0} retrieved an {1} error. Please check the URL and try again.\nRaw message: {2}".format(
-                    response.url, response.status_code, response.text
-                )
-            )
-        elif response.status_code == 501:
-            raise Exception(
-                "The URL {0} retrieved an {1} error. Please check the URL and try again.\nRaw message: {2}".format(
-                    response.url, response.status_code, response.text
-                )
-            )
-        elif response.status_code == 503:
-            raise Exception(
-                "The URL {0} retrieved an {1} error. Please check the URL and try again.\nRaw message: {2}".format(
-                    response.url, response.status_code, response.text
-                )
-            )
+
+        # One dict lookup instead of walking a ladder of status-code compares
+        template = self._ERROR_TEMPLATES.get(response.status_code)
+        if template is not None:
+            raise Exception(template.format(url=response.url, code=response.status_code, text=response.text))
+
+        if orjson is not None:  # 2-5x faster decode on the multi-MB payloads
+            return orjson.loads(response.content)
         return response.json()
 
     def get_data(self, type=None, **kwargs):
@@ -223,3 +257,122 @@ class Client:
         if type is not None and id is not None:
             return self._delete("{0}({1})".format(type, id))
         raise Exception("A type is necessary. Example: contacts, leads, accounts, etc... check the library")
+
+    def batch(self):
+        """
+        Returns a context manager that buffers create/update/delete operations
+        and sends them all in a single $batch request on exit.
+        :return: A BatchRequest bound to this client.
+        """
+        return BatchRequest(self)
+
+    def send_batch(self, operations):
+        """
+        Sends the buffered operations as one multipart $batch request.
+        Dynamics 365 rejects changesets with more than one request, so every
+        operation is wrapped in its own changeset.
+        :param operations: A list of (method, endpoint, json) tuples.
+        :return: A list with one result (or Exception) per operation, in order.
+        """
+        assert self.domain is not None, "'domain' is required"
+        assert self.access_token is not None, "You must provide a 'token' to make requests"
+        if not operations:
+            return []
+
+        batch_boundary = f"batch_{uuid.uuid4()}"
+        lines = []
+        for method, endpoint, payload in operations:
+            changeset_boundary = f"changeset_{uuid.uuid4()}"
+            lines += [
+                f"--{batch_boundary}",
+                f"Content-Type: multipart/mixed; boundary={changeset_boundary}",
+                "",
+                f"--{changeset_boundary}",
+                "Content-Type: application/http",
+                "Content-Transfer-Encoding: binary",
+                "Content-ID: 1",
+                "",
+                f"{method.upper()} {self._base_url}{endpoint} HTTP/1.1",
+            ]
+            if payload is not None:
+                lines += ["Content-Type: application/json", "", json_lib.dumps(payload)]
+            else:
+                lines += [""]
+            lines += [f"--{changeset_boundary}--"]
+        lines += [f"--{batch_boundary}--", ""]
+
+        headers = dict(self.headers)
+        headers["Content-Type"] = f"multipart/mixed; boundary={batch_boundary}"
+        url = self._base_url + "$batch"
+        response = self.session.post(url, headers=headers, data="\r\n".join(lines).encode("utf-8"))
+        if response.status_code >= 400:
+            return self.parse_response(response)  # Batch-level failure, raise as usual
+        return self.parse_batch_response(response)
+
+    def parse_batch_response(self, response):
+        """
+        This method splits a multipart $batch response into its per-operation
+        parts and returns results or exceptions in the original order.
+        :param response:
+        :return:
+        """
+        boundary_match = re.search(r'boundary=("?)([^";]+)\1', response.headers.get("Content-Type", ""))
+        assert boundary_match is not None, "The $batch response has no multipart boundary"
+        boundary = boundary_match.group(2)
+
+        results = []
+        for part in response.text.split(f"--{boundary}"):
+            status_match = re.search(r"HTTP/1\.1 (\d{3})", part)
+            if status_match is None:  # Preamble/epilogue parts carry no response
+                continue
+            status_code = int(status_match.group(1))
+            if status_code >= 400:
+                results.append(Exception(
+                    "A batch operation retrieved an {0} error.\nRaw message: {1}".format(status_code, part)
+                ))
+            else:
+                entity_id_match = re.search(r"OData-EntityId:\s*(\S+)", part)
+                if entity_id_match is not None:
+                    guid = entity_id_match.group(1)[-37:-1]
+                    results.append(guid if _GUID_RE.match(guid) else True)
+                else:
+                    results.append(True)
+        return results
+
+
+class BatchRequest:
+    """
+    Buffers create/update/delete operations for a single $batch request.
+    Obtain one via Client.batch() and use it as a context manager; results
+    are available on the 'results' attribute after the block exits.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+        self.results = None
+
+    def create_data(self, type=None, **kwargs):
+        if type is not None and kwargs is not None:
+            self.operations.append(("POST", type, dict(kwargs)))
+            return
+        raise Exception("A type is necessary. Example: contacts, leads, accounts, etc... check the library")
+
+    def update_data(self, type=None, id=None, **kwargs):
+        if type is not None and id is not None:
+            self.operations.append(("PATCH", "{0}({1})".format(type, id), dict(kwargs)))
+            return
+        raise Exception("A type is necessary. Example: contacts, leads, accounts, etc... check the library")
+
+    def delete_data(self, type=None, id=None):
+        if type is not None and id is not None:
+            self.operations.append(("DELETE", "{0}({1})".format(type, id), None))
+            return
+        raise Exception("A type is necessary. Example: contacts, leads, accounts, etc... check the library")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.results = self.client.send_batch(self.operations)
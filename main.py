@@ -1,43 +1,93 @@
+# Heavyweight modules (pandas, yaml, msal, pyarrow) are imported lazily at
+# their call sites, so startup and error paths don't pay their init cost
+from __future__ import annotations
+
+import json
 import os
-import yaml
-import adal
+import sys
 import time
-import pandas as pd
-from d365api import Client
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from d365api import Client, NOT_MODIFIED
 
 CONFIG_FILEPATH = 'config.yaml'
 RESULTS_PATH = 'results'
+CACHE_PATH = os.path.join(RESULTS_PATH, '.cache')
+TOKEN_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'd365_schema_compare')
 CLEAN_RESULTS = True  # Empties the RESULTS_PATH folder, starting each time with a clean slate
 VERBOSE = False  # Just shows some verbose info about fields collected
 
+# Single source of truth for the metadata request; the $select on the expand
+# keeps the payload down to the attribute fields the tool actually reads
+ENTITY_DEFS_REQ = dict(
+    endpoint='EntityDefinitions',
+    select='LogicalName',
+    expand='Attributes($select=LogicalName,AttributeType,MaxLength)',
+)
+
+
+@dataclass(frozen=True)
+class EnvConfig:
+    # Immutable connection settings of a single environment; __slots__ is
+    # spelled out by hand to stay compatible with pre-3.10 dataclasses
+    __slots__ = ('tenant_id', 'client_id', 'client_secret', 'client_url')
+    tenant_id: str
+    client_id: str
+    client_secret: str
+    client_url: str
+
 
 class ClientManager:
-    access_token = None
-    access_token_refresh_time = None
-    tenant_id = None
-    client_url = None
-    client_id = None
-    client_secret = None
-    client_object = None
+    __slots__ = ('access_token', 'tenant_id', 'client_url', 'client_id', 'client_secret',
+                 'client_object', 'msal_app', 'token_cache')
 
     def __init__(self, tenant_id: str, client_url: str, client_id: str, client_secret: str):
         self.tenant_id = tenant_id
         self.client_url = client_url
         self.client_id = client_id
         self.client_secret = client_secret
+        self.access_token = None
+        self.client_object = None
+        self.msal_app = None
+        self.token_cache = None
+
+    def _token_cache_filepath(self) -> str:
+        return os.path.join(TOKEN_CACHE_PATH, f"token_{self.tenant_id}_{self.client_id}.json")
+
+    def _save_token_cache(self) -> None:
+        os.makedirs(TOKEN_CACHE_PATH, exist_ok=True)
+        cache_filepath = self._token_cache_filepath()
+        temp_filepath = cache_filepath + '.tmp'
+        with open(temp_filepath, 'w') as cache_file:
+            cache_file.write(self.token_cache.serialize())
+        os.chmod(temp_filepath, 0o600)  # The cache holds a usable bearer token
+        os.replace(temp_filepath, cache_filepath)  # Atomic swap
 
     def get_access_token(self):
-        if self.access_token_refresh_time is None or (time.time() - self.access_token_refresh_time) > 60:  # If N seconds have passed, get a new token
-            authority_url = 'https://login.microsoftonline.com/' + self.tenant_id
-            context = adal.AuthenticationContext(authority_url)
-            token = context.acquire_token_with_client_credentials(
-                resource=self.client_url,
+        if self.msal_app is None:  # First time being called
+            import msal
+            # Persisting MSAL's cache across invocations means a fresh CLI run
+            # can skip the AAD round trip while the last token is still valid
+            self.token_cache = msal.SerializableTokenCache()
+            try:
+                with open(self._token_cache_filepath()) as cache_file:
+                    self.token_cache.deserialize(cache_file.read())
+            except (OSError, ValueError):  # No cache yet, or an unreadable one
+                pass
+            self.msal_app = msal.ConfidentialClientApplication(
                 client_id=self.client_id,
-                client_secret=self.client_secret
+                authority='https://login.microsoftonline.com/' + self.tenant_id,
+                client_credential=self.client_secret,
+                token_cache=self.token_cache
             )
-            self.access_token = token["accessToken"]
-            self.access_token_refresh_time = time.time()
-        # In any case return the token object
+        # MSAL serves the token from its cache until close to the real expiry,
+        # so this only goes back to AAD when a refresh is actually needed
+        token = self.msal_app.acquire_token_for_client(scopes=[f"{self.client_url}/.default"])
+        if 'access_token' not in token:
+            raise Exception(f"Authentication failed: {token.get('error_description', token)}")
+        if self.token_cache.has_state_changed:
+            self._save_token_cache()
+        self.access_token = token['access_token']
         return self.access_token
 
     def get_client_object(self):
@@ -50,7 +100,10 @@ class ClientManager:
 
 
 # Print iterations progress
-def print_progress_bar(start_time: float, iteration, total, prefix='', decimals=1, length=100, fill='█', end="\r"):
+_progress_state = {'last_emit': 0.0, 'filled_length': -1, 'bar': ''}
+
+
+def print_progress_bar(start_time: float, iteration, total, prefix='', decimals=1, length=100, fill='█', end="\r", inv_total=None):
     """
     Call in a loop to create terminal progress bar
     @params:
@@ -63,12 +116,25 @@ def print_progress_bar(start_time: float, iteration, total, prefix='', decimals=
         length      - Optional  : character length of bar (Int)
         fill        - Optional  : bar fill character (Str)
         end         - Optional  : end character (e.g. "\r", "\r\n") (Str)
+        inv_total   - Optional  : precomputed 1.0/total, saves a division per tick (Float)
     """
-    percentage = (100 * (iteration / float(total)))
-    percentage_str = ("{0:." + str(decimals) + "f}").format(percentage)
-
-    elapsed_time = time.time() - start_time
-    total_time = ((elapsed_time * 100) / percentage) if percentage > 0 else 0  # Avoid division by zero
+    # Cheap modulo gate first, so ~99.5% of ticks return before even paying
+    # for the time.time() call of the wall-clock throttle below
+    if iteration != total and iteration % max(1, total // 200):
+        return
+
+    # Throttle to ~10 refreshes per second: at high iteration counts the
+    # strftime calls, bar building and tty writes otherwise dominate the loop
+    now = time.time()
+    if iteration != total and (now - _progress_state['last_emit']) < 0.1:
+        return
+    _progress_state['last_emit'] = now
+
+    percentage = (100.0 * iteration * inv_total) if inv_total is not None else (100 * (iteration / float(total)))
+    percentage_str = f"{percentage:.{decimals}f}"
+
+    elapsed_time = now - start_time
+    total_time = (elapsed_time * total / iteration) if iteration > 0 else 0  # Avoid division by zero
     remaining_time = (total_time - elapsed_time) if (total_time - elapsed_time) >= 0 else 0
     elapsed_str = time.strftime('%M:%S', time.gmtime(elapsed_time))
     remaining_str = time.strftime('%M:%S', time.gmtime(remaining_time))
@@ -76,28 +142,80 @@ def print_progress_bar(start_time: float, iteration, total, prefix='', decimals=
 
     speed = int((iteration / elapsed_time) * 60) if elapsed_time > 0 else 0  # Avoid division by zero
     filled_length = int(length * iteration // total)
-    bar = fill * filled_length + '-' * (length - filled_length)
+    if filled_length != _progress_state['filled_length']:  # Rebuild the bar only when it visibly moves
+        _progress_state['filled_length'] = filled_length
+        _progress_state['bar'] = fill * filled_length + '-' * (length - filled_length)
+    bar = _progress_state['bar']
     iter_vs_tot = f'{iteration}/{total}'
-    print(f'\r{prefix} |{bar}| {iter_vs_tot.ljust(9)} ({percentage_str}%) {speed}/min {elapsed_and_remaining}', end=end)
+    sys.stdout.write(f'\r{prefix} |{bar}| {iter_vs_tot.ljust(9)} ({percentage_str}%) {speed}/min {elapsed_and_remaining}{end}')
     # Print New Line on Complete
     if iteration == total:
-        print()
+        sys.stdout.write('\n')
+    sys.stdout.flush()
+
+
+def load_metadata_cache(environment_name: str):
+    cache_filepath = os.path.join(CACHE_PATH, f"{environment_name}.json")
+    try:
+        with open(cache_filepath) as cache_file:
+            cached = json.load(cache_file)
+        return cached.get('etag'), cached
+    except (OSError, ValueError):  # No cache yet, or an unreadable one
+        return None, None
+
 
+def save_metadata_cache(environment_name: str, etag: str, df, total_entities: int) -> None:
+    if etag is None:  # Nothing to revalidate against on the next run
+        return
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    cache_filepath = os.path.join(CACHE_PATH, f"{environment_name}.json")
+    with open(cache_filepath, 'w') as cache_file:
+        json.dump({'etag': etag, 'total_entities': total_entities, 'fields': df.to_dict(orient='list')}, cache_file)
+
+
+def get_entity_definitions(client_manager: ClientManager, environment_name: str):
+    import pandas as pd
 
-def get_entity_definitions(client_manager: ClientManager):
     time_start = time.time()
 
     client = client_manager.get_client_object()
-    result = client.make_request(
-        method='get',
-        endpoint='EntityDefinitions',
-        select='LogicalName',
-        expand='Attributes',
-    )
+
+    # Revalidate the cached schema with If-None-Match: on a 304 the whole
+    # multi-MB download is skipped and the cached body is reused
+    etag, cached = load_metadata_cache(environment_name)
+    extra_headers = {'If-None-Match': etag} if etag is not None else None
+
+    # Consume the paged response one page at a time, so peak memory stays at
+    # O(one page) instead of holding every entity dict plus the DataFrame
+    frames = []
+    total_entities = 0
+    cache_hit = False
+    for page in client.iter_pages(extra_headers=extra_headers, **ENTITY_DEFS_REQ):
+        if page is NOT_MODIFIED:
+            cache_hit = True
+            break
+        if not frames:  # The ETag to revalidate against comes with the first page
+            etag = client.last_response_etag
+        total_entities += len(page)
+        frames.append(pd.json_normalize(data=page, record_path=['Attributes'], meta=['LogicalName'], meta_prefix='Entity_'))
+
+    if cache_hit:
+        df = pd.DataFrame(data=cached['fields'])
+        total_entities = cached['total_entities']
+    else:
+        df = pd.concat(objs=frames, ignore_index=True) if frames else pd.DataFrame()
+        df = df.reindex(columns=['Entity_LogicalName', 'LogicalName', 'AttributeType', 'MaxLength'])
+        df.columns = ['EntityName', 'ColumnName', 'ColumnType', 'ColumnLength']
+        save_metadata_cache(environment_name=environment_name, etag=etag, df=df, total_entities=total_entities)
+
+    # Low-cardinality strings repeated across many rows: dictionary-encode
+    # them so merges and groupbys hash integer codes instead of Python strings
+    df['EntityName'] = df['EntityName'].astype('category')
+    df['ColumnType'] = df['ColumnType'].astype('category')
 
     time_end = time.time()
     time_taken = time_end - time_start
-    return result, time_taken
+    return df, total_entities, time_taken
 
 
 def load_config() -> dict:
@@ -106,29 +224,48 @@ def load_config() -> dict:
     # Let's start by stating some obvious facts
     print(f"==> Configuration file: {CONFIG_FILEPATH}")
 
-    with open(CONFIG_FILEPATH) as config_file:
-        config = yaml.load(config_file, Loader=yaml.FullLoader)
-
-        if 'environments' in config:
-            for environment in config['environments']:
-                print(f"==> Environment configuration found: {environment}")
-        else:
-            raise SyntaxError("==> Configuration incorrect. Missing 'environments' key.")
+    # Parsed-config sidecar: JSON loads an order of magnitude faster than
+    # YAML, so reuse it on repeated runs for as long as the YAML is unchanged
+    config_cache_filepath = CONFIG_FILEPATH + '.json'
+    config = None
+    try:
+        if os.stat(config_cache_filepath).st_mtime >= os.stat(CONFIG_FILEPATH).st_mtime:
+            with open(config_cache_filepath) as config_cache_file:
+                config = json.load(config_cache_file)
+    except (OSError, ValueError):  # No sidecar yet, or an unreadable one
+        config = None
+
+    if config is None:  # The YAML stays the source of truth
+        import yaml
+        with open(CONFIG_FILEPATH) as config_file:
+            # The config is all strings, so the bare Base loader can skip the
+            # scalar tag resolvers entirely (C variant when libyaml is there)
+            config = yaml.load(config_file, Loader=getattr(yaml, 'CBaseLoader', yaml.BaseLoader))
+        with open(config_cache_filepath, 'w') as config_cache_file:
+            json.dump(config, config_cache_file)
+
+    if 'environments' in config:
+        for environment in config['environments']:
+            print(f"==> Environment configuration found: {environment}")
+    else:
+        raise SyntaxError("==> Configuration incorrect. Missing 'environments' key.")
 
-        if 'baseline' in config:
-            if config['baseline'] in config['environments']:
-                print(f"==> Using {config['baseline']} as baseline")
-            else:
-                raise ValueError(f"==> Baseline environment {config['baseline']} is not in the configured environments.")
+    if 'baseline' in config:
+        if config['baseline'] in config['environments']:
+            print(f"==> Using {config['baseline']} as baseline")
         else:
-            raise SyntaxError("==> Configuration incorrect. Missing 'baseline' key.")
+            raise ValueError(f"==> Baseline environment {config['baseline']} is not in the configured environments.")
+    else:
+        raise SyntaxError("==> Configuration incorrect. Missing 'baseline' key.")
 
     # Clear or create results folder
     if os.path.isdir(RESULTS_PATH):
         if CLEAN_RESULTS:
             print(f"==> Clearing '{RESULTS_PATH}' folder")
             for file in os.listdir(RESULTS_PATH):
-                os.remove(os.path.join(RESULTS_PATH, file))
+                file_path = os.path.join(RESULTS_PATH, file)
+                if os.path.isfile(file_path):  # Keep the .cache folder around
+                    os.remove(file_path)
     else:
         print(f"==> Creating '{RESULTS_PATH}' folder")
         os.mkdir(RESULTS_PATH)
@@ -137,116 +274,123 @@ def load_config() -> dict:
     return config
 
 
-def get_metadata(config: dict) -> None:
-    for environment_name in config['environments']:
-        environment_config = config['environments'][environment_name]
-        print(f"==> ({environment_name}) Started working on environment")
-
-        # Loading environment configuration
-        tenant_id = environment_config['tenant_id']
-        client_url = environment_config['client_url']
-        client_id = environment_config['client_id']
-        client_secret = environment_config['client_secret']
-
-        # Logging in to the system
-        print(f"==> ({environment_name}) Authenticating on Dynamics 365...")
-        client_manager = ClientManager(
-            tenant_id=tenant_id,
-            client_url=client_url,
-            client_id=client_id,
-            client_secret=client_secret
-        )
-
-        # Getting entity structure
-        print(f"==> ({environment_name}) Retrieving entity definitions...")
-        result, time_taken = get_entity_definitions(client_manager=client_manager)
-        print(f"==> ({environment_name}) It took {time_taken:.1f}s to retrieve {len(result['value'])} items")
-
-        entity_definitions = result['value']
-        entity_fields = []
-        for entity in entity_definitions:
-            entity_logical_name = entity['LogicalName']
-            entity_attributes = entity['Attributes']
-            for attribute in entity_attributes:
-                attribute = dict(attribute)  # sanitize object type
-                logical_name = attribute.get('LogicalName')
-                attribute_type = attribute.get('AttributeType')
-                max_length = attribute.get('MaxLength')
-                entity_fields += [[entity_logical_name, logical_name, attribute_type, max_length]]
-                if VERBOSE:
-                    print(f"Entity {entity_logical_name}: {logical_name} - {attribute_type}({max_length})")
-
-        df = pd.DataFrame.from_records(data=entity_fields, columns=['EntityName', 'ColumnName', 'ColumnType', 'ColumnLength'])
-        environment_output = os.path.join(RESULTS_PATH, f"entity_fields_{environment_name}.csv")
-        df.to_csv(path_or_buf=environment_output, index=False)
-
-        print(f"==> ({environment_name}) Done!")
+def write_csv(df: pd.DataFrame, output_path: str) -> None:
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pyarrow_csv
+    except ImportError:  # pyarrow is optional, fall back to the pandas writer
+        pa = None
 
-    return
+    if pa is not None:  # Arrow's columnar C++ writer beats the row-oriented pandas one
+        pyarrow_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), output_path)
+    else:
+        df.to_csv(path_or_buf=output_path, index=False)
+
+
+def process_environment(environment_name: str, environment_config: dict) -> pd.DataFrame:
+    print(f"==> ({environment_name}) Started working on environment")
+
+    # Loading environment configuration
+    env = EnvConfig(**environment_config)
+
+    # Logging in to the system
+    print(f"==> ({environment_name}) Authenticating on Dynamics 365...")
+    client_manager = ClientManager(
+        tenant_id=env.tenant_id,
+        client_url=env.client_url,
+        client_id=env.client_id,
+        client_secret=env.client_secret
+    )
+
+    # Getting entity structure
+    print(f"==> ({environment_name}) Retrieving entity definitions...")
+    df, total_entities, time_taken = get_entity_definitions(client_manager=client_manager, environment_name=environment_name)
+    print(f"==> ({environment_name}) It took {time_taken:.1f}s to retrieve {total_entities} items")
 
+    if VERBOSE:
+        # Buffer the whole dump into one write: a flushing print per attribute
+        # would swamp the terminal on tenants with tens of thousands of fields
+        log_lines = [f"Entity {row.EntityName}: {row.ColumnName} - {row.ColumnType}({row.ColumnLength})"
+                     for row in df.itertuples(index=False)]
+        sys.stdout.write('\n'.join(log_lines) + '\n')
 
-def compare_environments(config: dict) -> None:
+    environment_output = os.path.join(RESULTS_PATH, f"entity_fields_{environment_name}.csv")
+    write_csv(df=df, output_path=environment_output)
+
+    print(f"==> ({environment_name}) Done!")
+    return df
+
+
+def get_metadata(config: dict) -> dict:
+    # Each environment spends most of its time blocked on D365 network I/O,
+    # so work all of them in parallel instead of one after the other
+    environments = config['environments']
+    environment_frames = {}
+    with ThreadPoolExecutor(max_workers=len(environments)) as executor:
+        futures = {executor.submit(process_environment, name, environments[name]): name for name in environments}
+        for future in as_completed(futures):
+            environment_frames[futures[future]] = future.result()  # Propagates any exception raised by the worker
+
+    return environment_frames
+
+
+def compare_environments(config: dict, environment_frames: dict) -> None:
+    import pandas as pd
 
     # We want to compare the baseline environment...
     baseline_name = config['baseline']
-    baseline_input = os.path.join(RESULTS_PATH, f"entity_fields_{baseline_name}.csv")
-    baseline_df = pd.read_csv(filepath_or_buffer=baseline_input)
-    baseline_df.sort_values(by=['EntityName', 'ColumnName'], ignore_index=True, inplace=True)
+    baseline_df = environment_frames[baseline_name]
 
     # ... with all the environments, except for itself, of course.
     for environment_name in [env for env in config['environments'] if env != baseline_name]:
         print(f"==> Comparing {environment_name} to {baseline_name} ")
-        environment_input = os.path.join(RESULTS_PATH, f"entity_fields_{environment_name}.csv")
-        environment_df = pd.read_csv(filepath_or_buffer=environment_input)
-        environment_df.sort_values(by=['EntityName', 'ColumnName'], ignore_index=True, inplace=True)
+        environment_df = environment_frames[environment_name]
+
+        # Categorical columns can only be compared when both sides share the
+        # same categories, so align them to their union before merging
+        union_types = baseline_df['ColumnType'].cat.categories.union(environment_df['ColumnType'].cat.categories)
+        baseline_df['ColumnType'] = baseline_df['ColumnType'].cat.set_categories(union_types)
+        environment_df['ColumnType'] = environment_df['ColumnType'].cat.set_categories(union_types)
 
         # Calculate merged dataframe and export it to .CSV
-        merged_df = environment_df.merge(right=baseline_df, how='outer', on=['EntityName', 'ColumnName'], suffixes=(f"_{environment_name}", f"_{baseline_name}"), indicator=True)
-        merged_df.sort_values(by=['EntityName', 'ColumnName'], ignore_index=True, inplace=True)
+        # sort=False keeps the join on the fast hash path; only the (much
+        # smaller) differences frame gets sorted for presentation below
+        merged_df = environment_df.merge(right=baseline_df, how='outer', on=['EntityName', 'ColumnName'], sort=False, suffixes=(f"_{environment_name}", f"_{baseline_name}"), indicator=True)
         merged_output_csv = os.path.join(RESULTS_PATH, f"merged_{environment_name}_{baseline_name}.csv")
-        merged_df.to_csv(path_or_buf=merged_output_csv, index=False)
-
-        # Calculate differences dataframe
-        differences_df = merged_df.drop(merged_df[
-            (
-                (merged_df[f"ColumnType_{environment_name}"] == merged_df[f"ColumnType_{baseline_name}"])
-                |
-                (merged_df[f"ColumnType_{environment_name}"].isna() & merged_df[f"ColumnType_{baseline_name}"].isna())
-            )
-            &
-            (
-                (merged_df[f"ColumnLength_{environment_name}"] == merged_df[f"ColumnLength_{baseline_name}"])
-                |
-                (merged_df[f"ColumnLength_{environment_name}"].isna() & merged_df[f"ColumnLength_{baseline_name}"].isna())
-            )
-        ].index)
-
-        # Replace indicator labels
-        differences_df = differences_df.astype({'_merge': 'str'})
-
-        differences_df.loc[(
-            (differences_df['_merge'] == 'both')
-            &
-            (differences_df[f"ColumnType_{environment_name}"] != differences_df[f"ColumnType_{baseline_name}"])
-        ), '_merge'] = "Different Type"
-        differences_df.loc[(
-            (differences_df['_merge'] == 'both')
-            &
-            (differences_df[f"ColumnType_{environment_name}"] == differences_df[f"ColumnType_{baseline_name}"])
-        ), '_merge'] = "Different Length"
-
-        differences_df = differences_df.replace(to_replace={
+        write_csv(df=merged_df, output_path=merged_output_csv)
+
+        # Calculate differences dataframe, keeping only the rows where type or
+        # length differ (a single boolean selection, no index rebuild + drop)
+        environment_type = merged_df[f"ColumnType_{environment_name}"]
+        baseline_type = merged_df[f"ColumnType_{baseline_name}"]
+        environment_length = merged_df[f"ColumnLength_{environment_name}"]
+        baseline_length = merged_df[f"ColumnLength_{baseline_name}"]
+        same_type = (environment_type == baseline_type) | (environment_type.isna() & baseline_type.isna())
+        same_length = (environment_length == baseline_length) | (environment_length.isna() & baseline_length.isna())
+        differences_df = merged_df.loc[~(same_type & same_length)].copy()
+
+        # Replace indicator labels, remapping only the _merge column instead
+        # of scanning every cell of every column for the sentinel strings
+        differences_df['_merge'] = differences_df['_merge'].astype('str')
+        type_differs = differences_df[f"ColumnType_{environment_name}"] != differences_df[f"ColumnType_{baseline_name}"]
+        differences_df.loc[(differences_df['_merge'] == 'both') & type_differs, '_merge'] = "Different Type"
+        differences_df.loc[(differences_df['_merge'] == 'both') & ~type_differs, '_merge'] = "Different Length"
+
+        differences_df['_merge'] = differences_df['_merge'].map({
             'left_only': f"Missing in {baseline_name}",  # left is environment, so missing in baseline
             'right_only': f"Missing in {environment_name}",  # right is baseline, so missing in environment
+            'Different Type': "Different Type",
+            'Different Length': "Different Length",
             'both': r"Different Type\Length"  # Any remaining 'both' is an error?
         })
         differences_df.rename(columns={'_merge': 'Difference'}, inplace=True)
+        differences_df.sort_values(by=['EntityName', 'ColumnName'], ignore_index=True, inplace=True)
 
-        differences_summary = differences_df.groupby(['EntityName', 'Difference'], as_index=False)["ColumnName"].count()
-        differences_summary = differences_summary.pivot_table(index='EntityName', columns='Difference', values='ColumnName', fill_value=0)
-        differences_summary = differences_summary.astype(int)
+        # Cross-tabulate entity vs difference kind in a single counting pass;
+        # the astype keeps unused entity categories from becoming zero rows
+        differences_summary = pd.crosstab(index=differences_df['EntityName'].astype(object), columns=differences_df['Difference'])
         differences_summary.reset_index(inplace=True)
-        differences_summary.columns.name = None  # Needed to avoid a phantom column due to pivot_table()
+        differences_summary.columns.name = None  # Needed to avoid a phantom column due to crosstab()
 
         # Generate HTML
         differences_output_detail = os.path.join(RESULTS_PATH, f"differences_{environment_name}_{baseline_name}_detail.html")
@@ -259,8 +403,8 @@ def compare_environments(config: dict) -> None:
 
 def main():
     config = load_config()
-    get_metadata(config=config)
-    compare_environments(config=config)
+    environment_frames = get_metadata(config=config)
+    compare_environments(config=config, environment_frames=environment_frames)
 
 
 if __name__ == '__main__':